@@ -1,10 +1,11 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from typing import List, Dict, Tuple
+from transformers import AutoTokenizer, AutoModelForCausalLM, LogitsProcessor, LogitsProcessorList
+from typing import Iterator, List, Dict, Tuple
 import json
 import os
 import argparse
+import threading
 
 app = Flask(__name__)
 
@@ -16,6 +17,158 @@ def load_config():
 
 config = load_config()
 
+# Request-path config values, hoisted so each request does a name lookup
+# instead of walking nested dicts (or rebuilding the model id list)
+_TEMPERATURE_DEFAULT = config['sampling_parameters']['temperature']['default']
+_TOP_P_DEFAULT = config['sampling_parameters']['top_p']['default']
+_AVAILABLE_MODEL_IDS = frozenset(model['id'] for model in config['available_models'])
+
+# Draft models for speculative decoding, keyed by target model. Draft and
+# target must share a tokenizer, so only same-family pairs are listed.
+_DRAFT_MODELS = {
+    'gpt2': 'distilgpt2',
+    'gpt2-medium': 'distilgpt2',
+    'gpt2-large': 'distilgpt2',
+    'gpt2-xl': 'distilgpt2',
+}
+
+def _quantized_model_dir(model_name):
+    return os.path.join(os.path.dirname(__file__), 'quantized', model_name.replace('/', '--'))
+
+def export_and_quantize(model_name: str) -> str:
+    """
+    One-time offline export of a model to ONNX with INT8 dynamic weight
+    quantization for faster CPU inference (run with --quantize MODEL_ID).
+    Requires the optional optimum[onnxruntime] dependency. TokenGenerator
+    picks up the resulting directory automatically when running on CPU.
+    """
+    from optimum.onnxruntime import ORTModelForCausalLM, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    save_dir = _quantized_model_dir(model_name)
+    print(f"Exporting {model_name} to ONNX...")
+    onnx_model = ORTModelForCausalLM.from_pretrained(model_name, export=True)
+    onnx_model.save_pretrained(save_dir)
+
+    print("Applying INT8 dynamic quantization...")
+    quantization_config = AutoQuantizationConfig.avx512_vnni(is_static=False)
+    for file_name in os.listdir(save_dir):
+        if file_name.endswith('.onnx'):
+            quantizer = ORTQuantizer.from_pretrained(save_dir, file_name=file_name)
+            quantizer.quantize(save_dir=save_dir, quantization_config=quantization_config)
+
+    print(f"Quantized model saved to {save_dir}")
+    return save_dir
+
+def _filter_and_sample(logits: torch.Tensor, temperature: torch.Tensor, top_k: int, top_p: torch.Tensor, apply_top_p: bool) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Apply temperature/top-k/top-p filtering to a logits vector and sample one
+    token. At most top_k tokens can survive the filters, so everything after
+    the initial topk runs on a k-sized vector rather than the full vocabulary.
+    temperature and top_p arrive as 0-dim tensors so that changing their
+    values reuses the compiled kernel; only top_k (a shape) and the
+    apply_top_p branch structure specialize.
+    Returns: (selected_id, selected_prob, top_probs, top_indices) as tensors,
+    sorted by descending probability.
+    """
+    # Sample in FP32 for numerical stability even when the model runs in
+    # FP16. Dividing by a temperature of 1.0 is cheaper than a
+    # value-specializing Python branch.
+    logits = logits.float() / temperature
+
+    # Softmax is monotonic, so topk on raw logits selects the same tokens as
+    # topk on probabilities. A single logsumexp reduction then gives the true
+    # probabilities for just the k survivors — the dense vocab-sized
+    # probability vector is never materialized.
+    k = top_k if 0 < top_k < logits.size(-1) else logits.size(-1)
+    top_logits, top_indices = torch.topk(logits, k)
+    top_probs = torch.exp(top_logits - torch.logsumexp(logits, dim=-1))
+
+    # Apply top-p (nucleus) filtering. The cumulative vector is already
+    # sorted, so the cutoff is a binary search: the first entry exceeding
+    # top_p is the last token kept, everything past it is masked
+    if apply_top_p:
+        cumulative_probs = torch.cumsum(top_probs, dim=-1)
+        cutoff = torch.searchsorted(cumulative_probs, top_p, right=True)
+        cut_mask = torch.arange(top_probs.size(-1), device=top_probs.device) > cutoff
+        top_probs = top_probs.masked_fill(cut_mask, 0.0)
+        top_logits = top_logits.masked_fill(cut_mask, float('-inf'))
+
+    # Renormalize for the reported probabilities
+    top_probs = top_probs / top_probs.sum()
+
+    # Sample via the Gumbel-max trick on the surviving logits: argmax of
+    # logits plus Gumbel noise draws from exactly the renormalized filtered
+    # distribution, and -inf (masked) candidates can never win
+    gumbel = -torch.log(-torch.log(torch.rand_like(top_logits)))
+    selected = torch.argmax(top_logits + gumbel, dim=-1, keepdim=True)
+    return top_indices[selected].squeeze(0), top_probs[selected].squeeze(0), top_probs, top_indices
+
+# Compiling fuses the ~10 vocab-sized kernel launches above into one generated
+# kernel and drops the intermediate allocations; fall back to eager if the
+# compile backend is unavailable on this platform
+try:
+    _filter_and_sample_compiled = torch.compile(_filter_and_sample, dynamic=False, fullgraph=True)
+except Exception:
+    _filter_and_sample_compiled = _filter_and_sample
+
+def _run_sampler(logits: torch.Tensor, temperature: float, top_k: int, top_p: float):
+    """Run the compiled sampler, permanently dropping to eager if compilation fails at runtime."""
+    global _filter_and_sample_compiled
+
+    # Dynamo specializes Python floats as constants, so passing the sliders
+    # through directly would recompile for every distinct value. Hand the
+    # continuous knobs over as 0-dim tensors instead.
+    temperature_t = torch.as_tensor(float(temperature), dtype=torch.float32, device=logits.device)
+    top_p_t = torch.as_tensor(float(top_p), dtype=torch.float32, device=logits.device)
+    apply_top_p = top_p < 1.0
+    try:
+        return _filter_and_sample_compiled(logits, temperature_t, top_k, top_p_t, apply_top_p)
+    except Exception:
+        if _filter_and_sample_compiled is _filter_and_sample:
+            raise
+        print("torch.compile sampler failed, falling back to eager execution")
+        _filter_and_sample_compiled = _filter_and_sample
+        return _filter_and_sample(logits, temperature_t, top_k, top_p_t, apply_top_p)
+
+class _InteractiveFilterProcessor(LogitsProcessor):
+    """
+    Temperature/top-k/top-p filtering with the exact semantics of
+    _filter_and_sample, for use with model.generate. HF's built-in
+    TopPLogitsWarper renormalizes the top-k survivors before applying the
+    nucleus threshold, while this app cuts on the cumulative unrenormalized
+    top-k mass — with the defaults (top_k=10, top_p=0.9) the two keep
+    different token sets, so the built-in warpers would make assisted
+    generation sample a different distribution than the interactive path.
+    """
+
+    def __init__(self, temperature: float, top_k: int, top_p: float):
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+
+    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor) -> torch.Tensor:
+        if self.temperature != 1.0:
+            scores = scores / self.temperature
+
+        # Mirror _filter_and_sample: rank-based top-k cut, then a nucleus cut
+        # on the cumulative (unrenormalized) filtered mass, keeping the token
+        # that crosses top_p. This runs once per verified token, off the
+        # interactive hot path, so dense vocab-sized ops are fine here.
+        sorted_probs, sorted_indices = torch.sort(torch.softmax(scores.float(), dim=-1), descending=True)
+        remove_sorted = torch.zeros_like(sorted_probs, dtype=torch.bool)
+        if self.top_k > 0:
+            ranks = torch.arange(scores.size(-1), device=scores.device)
+            remove_sorted |= ranks >= self.top_k
+            sorted_probs = sorted_probs.masked_fill(remove_sorted, 0.0)
+        if self.top_p < 1.0:
+            cumulative_probs = torch.cumsum(sorted_probs, dim=-1)
+            remove_sorted |= cumulative_probs - sorted_probs > self.top_p
+
+        # Restore vocabulary order and mask the removed tokens
+        remove = torch.zeros_like(remove_sorted).scatter(-1, sorted_indices, remove_sorted)
+        return scores.masked_fill(remove, float('-inf'))
+
 class TokenGenerator:
     def __init__(self, model_name):
         """Initialize the token generator with a pre-trained model."""
@@ -27,99 +180,329 @@ class TokenGenerator:
             self.device = torch.device("cpu")
         print(f"Using device: {self.device}")
         
-        # Load tokenizer and model
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModelForCausalLM.from_pretrained(model_name)
-        self.model.to(self.device)
-        self.model.eval()
-        
+        # Load tokenizer and model. Half precision on accelerators halves the
+        # weight bytes read per decode step, which is what bounds batch-1
+        # decoding; CPU stays FP32 where FP16 kernels are slow or missing.
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        if not self.tokenizer.is_fast:
+            print(f"Warning: no fast tokenizer available for {model_name}, encoding will be slower")
+
+        # On CPU, prefer an INT8 ONNX Runtime export if one was prepared with
+        # export_and_quantize (roughly 1.5-2x faster decode, ~4x less memory)
+        self.draft_model = None
+        self.model = self._try_load_quantized(model_name) if self.device.type == "cpu" else None
+        if self.model is None:
+            dtype = torch.float16 if self.device.type in ("cuda", "mps") else torch.float32
+            self.model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=dtype)
+            self.model.to(self.device)
+            self.model.eval()
+            # Speculative decoding: a small same-tokenizer draft model
+            # proposes several tokens that the target verifies in one forward
+            draft_name = _DRAFT_MODELS.get(model_name)
+            if draft_name:
+                try:
+                    self.draft_model = AutoModelForCausalLM.from_pretrained(draft_name, torch_dtype=dtype)
+                    self.draft_model.to(self.device)
+                    self.draft_model.eval()
+                    print(f"Loaded draft model {draft_name} for speculative decoding")
+                except Exception as e:
+                    print(f"Could not load draft model {draft_name}: {e}")
+            if self.device.type == "cuda":
+                self._compile_model(mode="reduce-overhead")
+            elif self.device.type == "cpu":
+                # TorchScript tracing cannot express the cached decode path
+                # (past_key_values is a shape-changing structure of tensors),
+                # so the CPU gets the same treatment through torch.compile's
+                # inductor backend. Inductor CPU compiles take tens of
+                # seconds, so go straight to dynamic kernels: one compile per
+                # frame up front instead of a static compile followed by the
+                # dynamic promotion recompile.
+                self._compile_model(mode=None, dynamic=True)
+
+        # This process never trains; autograd stays off for good. Grad mode is
+        # thread-local, so the inference paths below also carry
+        # @torch.inference_mode() to cover Flask's worker threads.
+        torch.set_grad_enabled(False)
+
         # Add padding token if it doesn't exist
         if self.tokenizer.pad_token is None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
-    
+
+        # Decoded-text cache: a handful of common token ids dominate the
+        # display lists, so most decodes become dictionary hits
+        self._token_text_cache = {}
+
+        # The forward pass and the session state are not reentrant, so
+        # concurrent Flask worker threads take turns on this generator
+        self._infer_lock = threading.RLock()
+
+        # Decode session state: the token ids on device, the KV cache, and the
+        # text they correspond to. A generate_to_end call that resumes exactly
+        # where the previous one stopped reuses all of it instead of
+        # re-encoding and re-processing the whole prefix.
+        self._session_text = None
+        self._session_ids = None
+        self._session_past = None
+
+    def _encode(self, text: str) -> torch.Tensor:
+        """Encode text to a (1, n) id tensor on device, skipping the tokenizer's attention-mask and padding work."""
+        # Special tokens are kept: several of the configured models prepend a
+        # BOS token, and dropping it would shift the distribution
+        ids = self.tokenizer(text, return_attention_mask=False)['input_ids']
+        if self.device.type == "cuda":
+            # Stage through pinned memory so the host-to-device copy runs as
+            # async DMA instead of blocking the Python thread; mostly matters
+            # for long prompts at session start
+            cpu_ids = torch.tensor([ids], dtype=torch.long).pin_memory()
+            return cpu_ids.to(self.device, non_blocking=True)
+        return torch.tensor([ids], dtype=torch.long, device=self.device)
+
+    def begin_session(self, text: str):
+        """Start a decode session: encode the text once and reset the KV cache."""
+        self._session_text = text
+        self._session_ids = self._encode(text)
+        self._session_past = None
+
+    def reset_session(self):
+        """Drop the cached session so the next generation starts from scratch."""
+        with self._infer_lock:
+            self._session_text = None
+            self._session_ids = None
+            self._session_past = None
+
+    @torch.inference_mode()
+    def step(self, top_k: int, temperature: float, top_p: float) -> Tuple[List[Dict], Dict]:
+        """Advance the session by one token, feeding the model only the ids the cache has not seen."""
+        # First step runs the full prompt; afterwards the cache covers
+        # everything except the most recently appended id
+        pending = self._session_ids if self._session_past is None else self._session_ids[:, -1:]
+        outputs = self.model(input_ids=pending, past_key_values=self._session_past, use_cache=True)
+        self._session_past = outputs.past_key_values
+
+        top_k_tokens, selected_token = self._select_next_token(outputs.logits[0, -1, :], top_k, temperature, top_p)
+        new_id = torch.tensor([[selected_token['token_id']]], device=self.device)
+        self._session_ids = torch.cat([self._session_ids, new_id], dim=1)
+        self._session_text += selected_token['token_text']
+        return top_k_tokens, selected_token
+
+    def _compile_model(self, mode, dynamic=None):
+        """
+        Wrap the model with torch.compile. Batch-1 cached decode launches many
+        tiny kernels, so the forward is dominated by per-op overhead; on CUDA
+        the reduce-overhead mode additionally replays the step as a CUDA graph.
+        Shapes must stay dynamic (dynamic=None promotes after the first
+        recompile): the prompt length and the growing past length change every
+        step, and pinning them would recompile per shape until dynamo's
+        recompile limit forced the model back to eager.
+        """
+        eager_model = self.model
+        try:
+            self.model = torch.compile(self.model, mode=mode, fullgraph=False, dynamic=dynamic)
+            # Warm up both the prefill and the single-token cached step so
+            # graph capture happens at load time, not on the first request
+            warmup_ids = torch.tensor([[self.tokenizer.eos_token_id or 0]], device=self.device)
+            with torch.inference_mode():
+                for _ in range(2):
+                    outputs = self.model(input_ids=warmup_ids, use_cache=True)
+                    self.model(input_ids=warmup_ids, past_key_values=outputs.past_key_values, use_cache=True)
+        except Exception as e:
+            print(f"torch.compile unavailable, running eager: {e}")
+            self.model = eager_model
+
+    def _try_load_quantized(self, model_name):
+        """Load the INT8 ONNX Runtime export for model_name if one exists."""
+        quant_dir = _quantized_model_dir(model_name)
+        if not os.path.isdir(quant_dir):
+            return None
+        try:
+            import onnxruntime
+            from optimum.onnxruntime import ORTModelForCausalLM
+        except ImportError:
+            print(f"Found quantized model in {quant_dir} but optimum[onnxruntime] is not installed, using PyTorch")
+            return None
+
+        # The directory holds both the FP32 export and the INT8 artifact
+        # (ORTQuantizer appends a _quantized suffix); pick the INT8 one
+        # explicitly, or optimum may refuse to choose or serve the FP32 file
+        quant_files = [f for f in os.listdir(quant_dir) if f.endswith('_quantized.onnx')]
+        if not quant_files:
+            print(f"No quantized .onnx artifact in {quant_dir}, using PyTorch")
+            return None
+
+        try:
+            sess_options = onnxruntime.SessionOptions()
+            sess_options.intra_op_num_threads = os.cpu_count()
+            print(f"Loading INT8 quantized model from {quant_dir}")
+            # ORTModelForCausalLM mirrors the HF forward API (past_key_values,
+            # torch-tensor logits), so the decode paths below work unchanged
+            return ORTModelForCausalLM.from_pretrained(quant_dir, file_name=quant_files[0], session_options=sess_options, use_cache=True)
+        except Exception as e:
+            print(f"Failed to load quantized model from {quant_dir}, using PyTorch: {e}")
+            return None
+
+    @torch.inference_mode()
     def get_next_token_probabilities(self, text: str, top_k: int = 10, temperature: float = 1.0, top_p: float = 0.9) -> Tuple[List[Dict], Dict]:
         """
         Given the text input, get the top token candidates and the selected token.
         Returns: (top_k_tokens_with_probs, selected_token_dict)
         """
-        # Tokenize input
-        inputs = self.tokenizer.encode(text, return_tensors="pt").to(self.device)
-        
-        with torch.no_grad():
+        with self._infer_lock:
+            # Tokenize input
+            inputs = self._encode(text)
+
             # Get model outputs
             outputs = self.model(inputs)
             logits = outputs.logits[0, -1, :]  # Get logits for the last token
-            
-            # Apply temperature scaling
-            if temperature != 1.0:
-                logits = logits / temperature
-            
-            # Convert to probabilities
-            probs = torch.softmax(logits, dim=-1)
-            
-            # Apply top-k filtering
-            if top_k > 0:
-                top_k_probs, top_k_indices = torch.topk(probs, min(top_k, probs.size(-1)))
-                # Zero out probabilities for tokens not in top-k
-                filtered_probs = torch.zeros_like(probs)
-                filtered_probs.scatter_(0, top_k_indices, top_k_probs)
-                probs = filtered_probs
-            
-            # Apply top-p (nucleus) filtering
-            if top_p < 1.0:
-                sorted_probs, sorted_indices = torch.sort(probs, descending=True)
-                cumulative_probs = torch.cumsum(sorted_probs, dim=0)
-                
-                # Find the cutoff point for top-p (include the token that exceeds top_p)
-                cutoff_index = torch.where(cumulative_probs > top_p)[0]
-                if len(cutoff_index) > 0:
-                    cutoff_index = cutoff_index[0] + 1  # Include the token that exceeded top_p
-                    # Zero out probabilities beyond the cutoff
-                    sorted_probs[cutoff_index:] = 0
-                    # Restore original order
-                    probs = torch.zeros_like(probs)
-                    probs.scatter_(0, sorted_indices, sorted_probs)
-            
-            # Renormalize probabilities
-            probs = probs / probs.sum()
-            
-            # Sample from the filtered distribution for the selected token
-            selected_token_id = torch.multinomial(probs, 1).item()
-            selected_token_text = self.tokenizer.decode([selected_token_id])
-            selected_token_prob = probs[selected_token_id].item()
-            
-            # Create selected token dictionary
-            selected_token = {
-                'token_id': selected_token_id,
-                'token_text': selected_token_text,
-                'probability': selected_token_prob
-            }
-            
-            # Get top tokens for display (from final filtered probabilities)
-            display_top_probs, display_top_indices = torch.topk(probs, min(12, (probs > 0).sum().item()))
-            
-            # Convert to list of dictionaries
-            display_top_tokens = []
-            for i in range(len(display_top_indices)):
-                token_id = display_top_indices[i].item()
-                token_text = self.tokenizer.decode([token_id])
-                probability = display_top_probs[i].item()
-                
-                display_top_tokens.append({
+            return self._select_next_token(logits, top_k, temperature, top_p)
+
+    def generate_to_end(self, text: str, max_tokens: int = 50, top_k: int = 10, temperature: float = 1.0, top_p: float = 0.9) -> Iterator[Dict]:
+        """
+        Generate up to max_tokens tokens, yielding each one as it is produced.
+        Reuses the KV cache so each step runs the model on only the newly
+        sampled token instead of re-encoding the whole growing prefix.
+        """
+        # Continue the existing session when the request resumes exactly where
+        # the previous generation stopped; otherwise encode from scratch.
+        # (Each step() carries its own inference_mode; a decorator here would
+        # only cover creating the generator, not its body.)
+        with self._infer_lock:
+            # With a draft model available, let HF's assisted generation
+            # verify several drafted tokens per target forward
+            if self.draft_model is not None:
+                yield from self._generate_assisted(text, max_tokens, top_k, temperature, top_p)
+                return
+
+            if self._session_text != text:
+                self.begin_session(text)
+
+            for _ in range(max_tokens):
+                top_k_tokens, selected_token = self.step(top_k, temperature, top_p)
+                yield {
+                    'selected_token': selected_token,
+                    'top_k_tokens': top_k_tokens
+                }
+
+                # Stop if we hit an end token
+                if selected_token['token_id'] == self.tokenizer.eos_token_id:
+                    break
+
+    @torch.inference_mode()
+    def _generate_assisted(self, text: str, max_tokens: int, top_k: int, temperature: float, top_p: float) -> List[Dict]:
+        """
+        Speculative decoding: the draft model runs ahead and the target
+        verifies its proposals in a single forward, typically 2-3x faster in
+        wall-clock time while sampling from the same distribution. The per-step
+        alternatives are rebuilt from the target's processed scores.
+        """
+        input_ids = self._encode(text)
+        outputs = self.model.generate(
+            input_ids,
+            assistant_model=self.draft_model,
+            max_new_tokens=max_tokens,
+            do_sample=True,
+            # Neutralize the built-in warpers (and any generation-config
+            # defaults); _InteractiveFilterProcessor applies this app's exact
+            # filtering semantics instead
+            temperature=1.0,
+            top_k=0,
+            top_p=1.0,
+            logits_processor=LogitsProcessorList([_InteractiveFilterProcessor(temperature, top_k, top_p)]),
+            return_dict_in_generate=True,
+            output_scores=True,
+            pad_token_id=self.tokenizer.pad_token_id,
+        )
+
+        generated_tokens = []
+        new_ids = outputs.sequences[0, input_ids.shape[1]:].tolist()
+        for step, token_id in enumerate(new_ids):
+            # The scores are the processed logits (temperature/top-k/top-p
+            # applied, filtered entries at -inf), so softmax recovers the same
+            # renormalized distribution the interactive sampler reports
+            step_probs = torch.softmax(outputs.scores[step][0].float(), dim=-1)
+            display_top_probs, display_top_indices = torch.topk(step_probs, min(12, step_probs.size(-1)))
+            display_ids = display_top_indices.cpu().tolist()
+            display_probs = display_top_probs.cpu().tolist()
+            while display_probs and display_probs[-1] == 0.0:
+                display_probs.pop()
+                display_ids.pop()
+
+            decoded_texts = self._decode_ids(display_ids + [token_id])
+            generated_tokens.append({
+                'selected_token': {
                     'token_id': token_id,
-                    'token_text': token_text,
-                    'probability': probability
-                })
-            
-            return display_top_tokens, selected_token
+                    'token_text': decoded_texts[-1],
+                    'probability': step_probs[token_id].item()
+                },
+                'top_k_tokens': [
+                    {'token_id': display_ids[i], 'token_text': decoded_texts[i], 'probability': display_probs[i]}
+                    for i in range(len(display_ids))
+                ]
+            })
+            if token_id == self.tokenizer.eos_token_id:
+                break
+
+        return generated_tokens
+
+    def _select_next_token(self, logits: torch.Tensor, top_k: int, temperature: float, top_p: float) -> Tuple[List[Dict], Dict]:
+        """Apply temperature/top-k/top-p filtering to last-token logits and sample."""
+        selected_id, selected_prob, top_probs, top_indices = _run_sampler(logits, temperature, top_k, top_p)
+        selected_token_id = selected_id.item()
+        selected_token_prob = selected_prob.item()
+
+        # Get top tokens for display (from final filtered probabilities);
+        # the filtered distribution is already sorted, so the display set is
+        # its leading nonzero entries
+        display_ids = top_indices[:12].cpu().tolist()
+        display_probs = top_probs[:12].cpu().tolist()
+        while display_probs and display_probs[-1] == 0.0:
+            display_probs.pop()
+            display_ids.pop()
+
+        # Decode the display tokens and the sampled token, hitting the text
+        # cache and batch-decoding whatever is left
+        decoded_texts = self._decode_ids(display_ids + [selected_token_id])
+
+        # Create selected token dictionary
+        selected_token = {
+            'token_id': selected_token_id,
+            'token_text': decoded_texts[-1],
+            'probability': selected_token_prob
+        }
+
+        # Convert to list of dictionaries
+        display_top_tokens = []
+        for i in range(len(display_ids)):
+            display_top_tokens.append({
+                'token_id': display_ids[i],
+                'token_text': decoded_texts[i],
+                'probability': display_probs[i]
+            })
+
+        return display_top_tokens, selected_token
     
+    def _decode_ids(self, token_ids: List[int]) -> List[str]:
+        """Decode token ids to text, batch-decoding only the cache misses."""
+        cache = self._token_text_cache
+        misses = [i for i in token_ids if i not in cache]
+        if misses:
+            if len(cache) > 8192:
+                cache.clear()
+            decoded = self.tokenizer.batch_decode([[i] for i in misses], skip_special_tokens=False)
+            cache.update(zip(misses, decoded))
+        return [cache[i] for i in token_ids]
+
     def decode_token(self, token_id: int) -> str:
         """Decode a single token ID to text."""
-        return self.tokenizer.decode([token_id])
+        return self._decode_ids([token_id])[0]
 
 # Global token generator instance
 token_gen = None
 
+# Already-loaded generators by model name, so switching back to a model is
+# O(1) instead of re-reading hundreds of MB of weights from disk
+_model_cache: Dict[str, TokenGenerator] = {}
+_model_cache_lock = threading.Lock()
+
 @app.route('/')
 def index():
     """Serve the main application page."""
@@ -149,10 +532,14 @@ def initialize_model():
             return jsonify({'status': 'error', 'message': 'Model name is required'}), 400
         
         # Validate model name against config
-        available_models = [model['id'] for model in config['available_models']]
-        if model_name not in available_models:
+        if model_name not in _AVAILABLE_MODEL_IDS:
             return jsonify({'status': 'error', 'message': f'Model {model_name} not available'}), 400
-        token_gen = TokenGenerator(model_name)
+        # Reuse an already-loaded generator; the lock keeps two concurrent
+        # initialize requests from loading the same weights twice
+        with _model_cache_lock:
+            if model_name not in _model_cache:
+                _model_cache[model_name] = TokenGenerator(model_name)
+            token_gen = _model_cache[model_name]
         return jsonify({'status': 'success', 'message': 'Model initialized successfully'})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -169,8 +556,8 @@ def generate_next_token():
         data = request.json
         text = data.get('text', '')
         top_k = data.get('top_k', 10)
-        temperature = data.get('temperature', config['sampling_parameters']['temperature']['default'])
-        top_p = data.get('top_p', config['sampling_parameters']['top_p']['default'])
+        temperature = data.get('temperature', _TEMPERATURE_DEFAULT)
+        top_p = data.get('top_p', _TOP_P_DEFAULT)
         
         # Get token probabilities and selected token
         top_k_tokens, selected_token = token_gen.get_next_token_probabilities(text, top_k, temperature, top_p)
@@ -186,44 +573,38 @@ def generate_next_token():
 
 @app.route('/generate_to_end', methods=['POST'])
 def generate_to_end():
-    """Generate tokens until a stopping condition is met."""
+    """Generate tokens until a stopping condition is met, streaming one NDJSON line per token."""
     global token_gen
-    
+
     if token_gen is None:
         return jsonify({'status': 'error', 'message': 'Model not initialized'}), 400
-    
-    try:
-        data = request.json
-        text = data.get('text', '')
-        max_tokens = data.get('max_tokens', 50)
-        top_k = data.get('top_k', 10)
-        temperature = data.get('temperature', config['sampling_parameters']['temperature']['default'])
-        top_p = data.get('top_p', config['sampling_parameters']['top_p']['default'])
-        
-        generated_tokens = []
-        current_text = text
-        
-        for _ in range(max_tokens):
-            top_k_tokens, selected_token = token_gen.get_next_token_probabilities(current_text, top_k, temperature, top_p)
-            
-            generated_tokens.append({
-                'selected_token': selected_token,
-                'top_k_tokens': top_k_tokens
-            })
-            
-            current_text += selected_token['token_text']
-            
-            # Stop if we hit an end token
-            if selected_token['token_id'] == token_gen.tokenizer.eos_token_id:
-                break
-        
-        return jsonify({
-            'status': 'success',
-            'generated_tokens': generated_tokens
-        })
-    
-    except Exception as e:
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+    data = request.json
+    text = data.get('text', '')
+    max_tokens = data.get('max_tokens', 50)
+    top_k = data.get('top_k', 10)
+    temperature = data.get('temperature', _TEMPERATURE_DEFAULT)
+    top_p = data.get('top_p', _TOP_P_DEFAULT)
+
+    def stream():
+        # Each token flushes as soon as it is sampled, so the client renders
+        # incrementally instead of waiting for all max_tokens
+        try:
+            for token_data in token_gen.generate_to_end(text, max_tokens, top_k, temperature, top_p):
+                yield json.dumps(token_data) + '\n'
+        except Exception as e:
+            yield json.dumps({'status': 'error', 'message': str(e)}) + '\n'
+
+    return Response(stream_with_context(stream()), mimetype='application/x-ndjson')
+
+@app.route('/reset', methods=['POST'])
+def reset_session():
+    """Invalidate the cached decode session (e.g. when the prompt is cleared)."""
+    global token_gen
+
+    if token_gen is not None:
+        token_gen.reset_session()
+    return jsonify({'status': 'success'})
 
 def parse_args():
     """Parse command line arguments."""
@@ -232,8 +613,13 @@ def parse_args():
                         help=f"Host to bind to (default: {config['server']['host']})")
     parser.add_argument('--port', type=int, default=config['server']['port'],
                         help=f"Port to bind to (default: {config['server']['port']})")
+    parser.add_argument('--quantize', type=str, metavar='MODEL_ID',
+                        help='Export MODEL_ID to INT8 ONNX for faster CPU inference, then exit')
     return parser.parse_args()
 
 if __name__ == '__main__':
     args = parse_args()
-    app.run(debug=True, host=args.host, port=args.port)
+    if args.quantize:
+        export_and_quantize(args.quantize)
+    else:
+        app.run(debug=True, host=args.host, port=args.port)
@@ -261,14 +261,28 @@ class TokenVisualizer {
                 })
             });
 
-            const data = await response.json();
-            
-            if (data.status === 'success') {
-                for (const tokenData of data.generated_tokens) {
+            // The server streams one NDJSON line per token; render each token
+            // as soon as its line arrives
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
+                for (const line of lines) {
+                    if (!line.trim()) continue;
+                    const tokenData = JSON.parse(line);
+                    if (tokenData.status === 'error') {
+                        console.error('Generation error:', tokenData.message);
+                        return;
+                    }
                     this.addToken(tokenData.selected_token, tokenData.top_k_tokens);
                 }
-            } else {
-                console.error('Generation error:', data.message);
             }
         } catch (error) {
             console.error('Request error:', error);
@@ -456,6 +470,8 @@ class TokenVisualizer {
     }
 
     reset() {
+        // Let the server drop its cached decode session
+        fetch('/reset', { method: 'POST' }).catch(() => {});
         this.generatedTokensData = [];
         this.originalPrompt = '';
         this.promptInput.value = '';